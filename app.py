@@ -1,223 +1,214 @@
 import streamlit as st
 import pandas as pd
-import hashlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import xxhash
+import re
+from pathlib import Path
 from datetime import datetime
 
 # === PREMIUM STYLING: Palantir Meets BCG ===
-st.markdown("""
-<style>
-    /* Core typography */
-    html, body, [class*="css"] {
-        font-family: 'Inter', -apple-system, BlinkMacSystemFont, sans-serif;
-        color: #0f172a;
-    }
-    
-    /* Layout */
-    .main .block-container {
-        padding-top: 2rem;
-        padding-bottom: 2rem;
-        max-width: 1200px;
-    }
-    
-    /* Header */
-    h1 {
-        font-weight: 800;
-        background: linear-gradient(90deg, #1e293b 0%, #4f46e5 100%);
-        -webkit-background-clip: text;
-        -webkit-text-fill-color: transparent;
-        background-clip: text;
-        margin-bottom: 0.25rem;
-    }
-    .subtitle {
-        color: #64748b;
-        font-size: 1.15rem;
-        font-weight: 500;
-        margin-bottom: 2rem;
-    }
-    
-    /* Upload zone */
-    .stFileUploader > div {
-        border: 2px dashed #e2e8f0;
-        border-radius: 16px;
-        padding: 2rem;
-        background: #f8fafc;
-        transition: all 0.3s ease;
-        text-align: center;
-    }
-    .stFileUploader > div:hover {
-        border-color: #818cf8;
-        background: #ffffff;
-        box-shadow: 0 4px 12px rgba(79, 70, 229, 0.08);
-    }
-    
-    /* KPI Cards */
-    .kpi-card {
-        background: white;
-        border-radius: 16px;
-        padding: 1.25rem;
-        box-shadow: 0 4px 6px -1px rgba(0,0,0,0.03), 0 2px 4px -1px rgba(0,0,0,0.02);
-        text-align: center;
-        flex: 1;
-        min-width: 120px;
-    }
-    .kpi-value {
-        font-size: 2rem;
-        font-weight: 700;
-        color: #1e293b;
-        margin: 0.5rem 0;
-    }
-    .kpi-label {
-        font-size: 0.875rem;
-        color: #64748b;
-    }
-    
-    /* Chart containers */
-    .chart-section {
-        margin: 2rem 0;
-    }
-    .chart-header {
-        display: flex;
-        justify-content: space-between;
-        align-items: center;
-        margin-bottom: 1rem;
-    }
-    .chart-title {
-        font-weight: 600;
-        font-size: 1.25rem;
-        color: #1e293b;
-    }
-    .explain-btn {
-        background: none;
-        border: none;
-        color: #6366f1;
-        cursor: pointer;
-        font-size: 0.875rem;
-        padding: 0.25rem;
-        border-radius: 6px;
-    }
-    .explain-btn:hover {
-        background: #f0f4ff;
-    }
-    .chart-card {
-        background: white;
-        border-radius: 16px;
-        padding: 1.5rem;
-        box-shadow: 0 4px 6px -1px rgba(0,0,0,0.03);
-        margin-bottom: 1.5rem;
-    }
-    
-    /* Export button */
-    .export-btn {
-        background: #4f46e5;
-        color: white;
-        border: none;
-        padding: 0.5rem 1.25rem;
-        border-radius: 12px;
-        font-weight: 600;
-        cursor: pointer;
-        transition: background 0.2s;
-    }
-    .export-btn:hover {
-        background: #4338ca;
-    }
-    
-    /* Footer */
-    .app-footer {
-        text-align: center;
-        color: #94a3b8;
-        font-size: 0.875rem;
-        margin-top: 3rem;
-        padding-top: 1.5rem;
-        border-top: 1px solid #e2e8f0;
-    }
-    
-    /* Hide Streamlit chrome */
-    #MainMenu, footer, .stDeployButton {visibility: hidden;}
-</style>
-""", unsafe_allow_html=True)
+@st.cache_resource
+def load_css():
+    """Read and minify the stylesheet once per server process"""
+    css = Path(__file__).with_name("insightflow.css").read_text()
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    return " ".join(css.split())
+
+st.markdown(f"<style>{load_css()}</style>", unsafe_allow_html=True)
 
 # === CACHEABLE DATA PROCESSING ===
+# SurveyCTO metadata columns to remove
+METADATA_COLS = {
+    'starttime', 'endtime', 'deviceimei', 'subscriberid',
+    '_version_', '_index', '_parent_index', 'audit',
+    'review_status', 'review_comment', 'formhub/uuid'
+}
+# Metadata still needed to compute survey duration
+TIMESTAMP_COLS = {'starttime', 'endtime'}
+# Text timestamps starting like 2023-02-13T10:35 or 2023-02-13 10:35
+ISO_TIMESTAMP = re.compile(r"\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}|$)")
+
+def hash_upload(uploaded_file):
+    """Hash the in-memory upload without copying it"""
+    with uploaded_file.getbuffer() as view:
+        return xxhash.xxh3_64_hexdigest(view)
+
+def read_first_sheet(upload, **kwargs):
+    """Read the first sheet, preferring the calamine engine over openpyxl"""
+    try:
+        upload.seek(0)
+        return pd.read_excel(upload, sheet_name=0, engine="calamine", **kwargs)
+    except Exception:
+        # calamine missing or unable to parse this file
+        upload.seek(0)
+        return pd.read_excel(upload, sheet_name=0, engine="openpyxl", **kwargs)
+
+def keep_column(col):
+    """usecols filter that leaves SurveyCTO metadata columns unparsed"""
+    return col not in METADATA_COLS
+
 @st.cache_data(show_spinner=False)
-def process_survey_file(file_content: bytes, file_name: str):
-    """Process file with full intelligence pipeline"""
-    df = pd.read_excel(file_content, sheet_name=0)
-    if df.empty:
-        return None, "Empty file"
-    
-    # Drop metadata rows
-    df = df.dropna(subset=[df.columns[0]], how='all')
-    
-    # SurveyCTO metadata columns to remove
-    metadata_cols = {
-        'starttime', 'endtime', 'deviceimei', 'subscriberid',
-        '_version_', '_index', '_parent_index', 'audit',
-        'review_status', 'review_comment', 'formhub/uuid'
-    }
-    cols_to_drop = [col for col in df.columns if col in metadata_cols]
-    clean_df = df.drop(columns=cols_to_drop, errors='ignore')
-    
-    # Schema inference
-    schema = {}
-    for col in clean_df.columns:
+def parse_xlsx(file_hash: str, _upload):
+    """Parse the raw sheet once; cached apart from the analysis steps"""
+    # Metadata columns are rejected by the reader instead of dropped later,
+    # except the first column, which decides which rows are blank
+    header = []
+    def usecols(col):
+        header.append(col)
+        return len(header) == 1 or keep_column(col) or col in TIMESTAMP_COLS
+    
+    df = read_first_sheet(_upload, usecols=usecols)
+    return df, sum(1 for col in header if not keep_column(col))
+
+def infer_schema(clean_df):
+    """Classify each column and measure its completeness"""
+    # Column-wise statistics in one pass each instead of per column
+    completeness = (1.0 - clean_df.isna().to_numpy().mean(axis=0)).tolist()
+    numeric_df = clean_df.select_dtypes(include=["number", "bool"], exclude=["timedelta"])
+    col_min, col_max = numeric_df.min().to_dict(), numeric_df.max().to_dict()
+    n_unique = clean_df.select_dtypes(include=["object", "string"]).nunique(dropna=True).to_dict()
+    # Categorical columns whose answers mix numbers and text
+    mixed_cols = set()
+    
+    def classify(col):
         col_lower = col.lower()
-        col_type = "other"
-        assumptions = []
         
         # GPS detection
         if 'lat' in col_lower or 'latitude' in col_lower:
-            col_type = "gps_lat"
-        elif 'lon' in col_lower or 'longitude' in col_lower:
-            col_type = "gps_lon"
+            return "gps_lat", []
+        if 'lon' in col_lower or 'longitude' in col_lower:
+            return "gps_lon", []
         # Categorical detection
-        elif clean_df[col].dtype == 'object':
+        if col in n_unique:
+            if n_unique[col] == 0:
+                return "empty", []
+            if n_unique[col] >= 15:
+                return "other", []
+            # Infer common patterns
             unique_vals = clean_df[col].dropna().unique()
-            if len(unique_vals) == 0:
-                col_type = "empty"
-            elif len(unique_vals) < 15:
-                col_type = "categorical"
-                # Infer common patterns
-                if set(unique_vals) <= {1, 2, '1', '2'}:
-                    assumptions.append("Assumed 1=Yes, 2=No")
-                elif set(unique_vals) <= {1, 2, 3, 4, 5}:
-                    assumptions.append("Treated as Likert scale")
+            if pd.api.types.infer_dtype(unique_vals, skipna=True).startswith("mixed"):
+                mixed_cols.add(col)
+            codes = pd.to_numeric(unique_vals, errors="coerce")
+            if np.isin(codes, [1, 2]).all():
+                return "categorical", ["Assumed 1=Yes, 2=No"]
+            if np.isin(codes, [1, 2, 3, 4, 5]).all():
+                return "categorical", ["Treated as Likert scale"]
+            return "categorical", []
         # Numeric detection
-        elif pd.api.types.is_numeric_dtype(clean_df[col]):
-            if clean_df[col].min() >= 0 and clean_df[col].max() <= 100:
-                col_type = "percentage"
-            else:
-                col_type = "numeric"
-        
+        if col in col_min:
+            if col_min[col] >= 0 and col_max[col] <= 100:
+                return "percentage", []
+            return "numeric", []
+        return "other", []
+    
+    schema = {}
+    for i, col in enumerate(clean_df.columns):
+        col_type, assumptions = classify(col)
         schema[col] = {
             "type": col_type,
             "assumptions": assumptions,
-            "completeness": 1 - clean_df[col].isnull().mean()
+            "completeness": completeness[i],
+            "mixed": col in mixed_cols
         }
+    return schema
+
+@st.cache_data(show_spinner=False)
+def process_survey_file(file_hash: str, _upload, file_name: str):
+    """Process file with full intelligence pipeline"""
+    df, metadata_dropped = parse_xlsx(file_hash, _upload)
+    if df.empty:
+        return None, "Empty file"
+    
+    # Drop metadata rows
+    clean_df = df.iloc[df.iloc[:, 0].notna().to_numpy()]
+    del df
+    
+    # Timestamps were only kept for the duration calculation
+    timestamps = {col: clean_df.pop(col) for col in TIMESTAMP_COLS if col in clean_df.columns}
+    if len(clean_df.columns) and not keep_column(clean_df.columns[0]):
+        del clean_df[clean_df.columns[0]]
+    
+    schema = infer_schema(clean_df)
+    
+    # Store low-cardinality answers as integer codes for charts and export
+    cat_cols = [col for col in clean_df.columns
+                if schema[col]["type"] == "categorical"]
+    for col in cat_cols:
+        # Mixed number/text answers would give categories Arrow cannot chart
+        if not schema[col]["mixed"]:
+            clean_df[col] = clean_df[col].astype("category")
+    
+    # Chart data for the top 4 categorical columns, computed once per file
+    chart_data = {col: clean_df[col].value_counts() for col in cat_cols[:4]}
     
     # Calculate survey duration if possible
     duration_info = None
-    if 'starttime' in df.columns and 'endtime' in df.columns:
-        try:
-            start = pd.to_datetime(df['starttime'], errors='coerce')
-            end = pd.to_datetime(df['endtime'], errors='coerce')
-            durations = (end - start).dt.total_seconds() / 60  # in minutes
-            valid_durations = durations[durations > 0]
-            if len(valid_durations) > 0:
-                duration_info = {
-                    "avg_minutes": round(valid_durations.mean(), 1),
-                    "count": len(valid_durations)
-                }
-        except:
-            pass
+    if len(timestamps) == 2:
+        start, end = timestamps['starttime'], timestamps['endtime']
+        if pd.api.types.is_datetime64_any_dtype(start) and pd.api.types.is_datetime64_any_dtype(end):
+            # Analytics-ready exports already hold real datetimes
+            start, end = pd.DatetimeIndex(start), pd.DatetimeIndex(end)
+        else:
+            # Parse both columns in one batch; the explicit format only
+            # applies when the text is ISO 8601 (e.g. not "Feb 13, 2023 10:35:12 AM")
+            values = np.concatenate([start.to_numpy(), end.to_numpy()])
+            sample = next((v for v in values if isinstance(v, str)), "")
+            iso_format = 'ISO8601' if ISO_TIMESTAMP.match(sample.strip()) else None
+            stamps = pd.to_datetime(values, errors='coerce', format=iso_format, utc=True, cache=True)
+            start, end = stamps[:len(clean_df)], stamps[len(clean_df):]
+        # Subtract in the native unit; nanoseconds overflow outside 1677-2262
+        durations = ((end - start) / pd.Timedelta(minutes=1)).to_numpy()  # in minutes
+        valid_durations = durations[start.notna() & end.notna() & (durations > 0)]
+        if len(valid_durations) > 0:
+            duration_info = {
+                "avg_minutes": round(valid_durations.mean(), 1),
+                "count": len(valid_durations)
+            }
     
     return {
-        "raw_df": df,
         "clean_df": clean_df,
         "schema": schema,
-        "metadata_dropped": len(cols_to_drop),
+        "metadata_dropped": metadata_dropped,
         "duration_info": duration_info,
+        "chart_data": chart_data,
         "filename": file_name
     }, None
 
+@st.cache_data(show_spinner=False)
+def load_preview(file_hash: str, _upload, rows: int = 10):
+    """Read only the first few rows for an instant preview"""
+    return read_first_sheet(_upload, nrows=rows, usecols=keep_column)
+
+def arrow_matches_pandas(arrow_type):
+    """Whether PyArrow writes this type the same way as DataFrame.to_csv"""
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    return (pa.types.is_integer(arrow_type) or pa.types.is_string(arrow_type)
+            or pa.types.is_large_string(arrow_type))
+
+@st.cache_data(show_spinner=False)
+def export_csv(file_hash: str, schema: dict, _clean_df):
+    """Encode the cleaned data as UTF-8 CSV, via PyArrow when the output is identical"""
+    try:
+        table = pa.Table.from_pandas(_clean_df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Mixed-type object columns have no Arrow type
+        table = None
+    # Only integer and text columns render exactly as DataFrame.to_csv does
+    if table is not None and all(arrow_matches_pandas(t) for t in table.schema.types):
+        buf = pa.BufferOutputStream()
+        # PyArrow always quotes header names, so let pandas write the header row
+        buf.write(_clean_df.iloc[:0].to_csv(index=False).encode('utf-8'))
+        try:
+            pacsv.write_csv(table, buf, pacsv.WriteOptions(include_header=False, quoting_style="none"))
+            return buf.getvalue().to_pybytes()
+        except pa.ArrowInvalid:
+            # A value needs quoting, which PyArrow would apply to the whole column
+            pass
+    return _clean_df.to_csv(index=False).encode('utf-8')
+
 # === MAIN APP ===
 st.title("InsightFlow")
 st.markdown('<div class="subtitle">Automated survey intelligence for field teams</div>', unsafe_allow_html=True)
@@ -225,12 +216,20 @@ st.markdown('<div class="subtitle">Automated survey intelligence for field teams
 uploaded_file = st.file_uploader("Upload your SurveyCTO export (XLSX)", type=["xlsx"], label_visibility="collapsed")
 
 if uploaded_file is not None:
-    # Generate file hash for caching
-    file_content = uploaded_file.getvalue()
-    file_hash = hashlib.md5(file_content).hexdigest()
+    # Generate file hash for caching; the upload buffer is not part of the key
+    file_hash = hash_upload(uploaded_file)
+    
+    # Show the first rows while a new file is parsed; reruns hit the cache
+    first_analysis = st.session_state.get("analyzed_file") != file_hash
+    if first_analysis:
+        preview = st.empty()
+        preview.dataframe(load_preview(file_hash, uploaded_file), use_container_width=True)
     
     with st.spinner("Analyzing your survey..."):
-        result, error = process_survey_file(file_content, uploaded_file.name)
+        result, error = process_survey_file(file_hash, uploaded_file, uploaded_file.name)
+    if first_analysis:
+        preview.empty()
+        st.session_state["analyzed_file"] = file_hash
     
     if error:
         st.error(f"❌ {error}")
@@ -253,60 +252,35 @@ if uploaded_file is not None:
     
     # === KPI SUMMARY ===
     st.subheader("Survey Health")
-    kpi_cols = st.columns(4)
-    
-    with kpi_cols[0]:
-        st.markdown(f"""
-        <div class="kpi-card">
-            <div class="kpi-value">{len(clean_df):,}</div>
-            <div class="kpi-label">Responses</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with kpi_cols[1]:
-        completeness = sum(1 for s in schema.values() if s["completeness"] > 0.9) / len(schema) if schema else 0
-        st.markdown(f"""
-        <div class="kpi-card">
-            <div class="kpi-value">{completeness:.0%}</div>
-            <div class="kpi-label">High-Quality Fields</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with kpi_cols[2]:
-        gps_count = sum(1 for col in clean_df.columns if 'lat' in col.lower() or 'lon' in col.lower())
-        st.markdown(f"""
-        <div class="kpi-card">
-            <div class="kpi-value">{"Yes" if gps_count >= 2 else "No"}</div>
-            <div class="kpi-label">Geotagged</div>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with kpi_cols[3]:
-        if data["duration_info"]:
-            st.markdown(f"""
-            <div class="kpi-card">
-                <div class="kpi-value">{data['duration_info']['avg_minutes']}m</div>
-                <div class="kpi-label">Avg. Duration</div>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="kpi-card">
-                <div class="kpi-value">—</div>
-                <div class="kpi-label">Duration</div>
-            </div>
-            """, unsafe_allow_html=True)
+    completeness = sum(1 for s in schema.values() if s["completeness"] > 0.9) / len(schema) if schema else 0
+    # Reuse the GPS classification from schema inference
+    col_types = {s["type"] for s in schema.values()}
+    geotagged = "gps_lat" in col_types and "gps_lon" in col_types
+    if data["duration_info"]:
+        duration_kpi = (f"{data['duration_info']['avg_minutes']}m", "Avg. Duration")
+    else:
+        duration_kpi = ("—", "Duration")
+    
+    kpis = [
+        (f"{len(clean_df):,}", "Responses"),
+        (f"{completeness:.0%}", "High-Quality Fields"),
+        ("Yes" if geotagged else "No", "Geotagged"),
+        duration_kpi,
+    ]
+    # All four cards in a single element
+    cards = "".join(
+        f'<div class="kpi-card"><div class="kpi-value">{value}</div><div class="kpi-label">{label}</div></div>'
+        for value, label in kpis
+    )
+    st.markdown(f'<div class="kpi-row">{cards}</div>', unsafe_allow_html=True)
     
     # === CONTEXTUAL CHARTS ===
     st.markdown('<div class="chart-section">', unsafe_allow_html=True)
     st.subheader("Key Insights")
     
     # Prioritize charts: categorical first, then GPS
-    cat_cols = [col for col in clean_df.columns 
-                if schema[col]["type"] == "categorical"]
-    
-    if cat_cols:
-        for col in cat_cols[:4]:  # Top 4 only
+    if data["chart_data"]:
+        for col, counts in data["chart_data"].items():  # Top 4 only
             with st.container():
                 col1, col2 = st.columns([6,1])
                 with col1:
@@ -320,7 +294,7 @@ if uploaded_file is not None:
                             st.caption("Raw values sample:")
                             st.code(clean_df[col].dropna().head(3).to_list())
                 
-                st.bar_chart(clean_df[col].value_counts(), use_container_width=True)
+                st.bar_chart(counts, use_container_width=True)
                 st.markdown('</div>', unsafe_allow_html=True)
     
     # GPS Map
@@ -328,12 +302,11 @@ if uploaded_file is not None:
     lon_col = next((c for c in clean_df.columns if schema[c]["type"] == "gps_lon"), None)
     
     if lat_col and lon_col:
-        gps_df = clean_df[[lat_col, lon_col]].dropna()
-        gps_df = gps_df.rename(columns={lat_col: 'latitude', lon_col: 'longitude'})
-        gps_df = gps_df[
-            (gps_df['latitude'].between(-90, 90)) & 
-            (gps_df['longitude'].between(-180, 180))
-        ]
+        # st.map needs float64 to serialize the points; NaN fails the range test
+        lat = pd.to_numeric(clean_df[lat_col], errors='coerce').to_numpy(dtype=np.float64)
+        lon = pd.to_numeric(clean_df[lon_col], errors='coerce').to_numpy(dtype=np.float64)
+        mask = (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+        gps_df = pd.DataFrame({'latitude': lat[mask], 'longitude': lon[mask]})
         if not gps_df.empty:
             with st.container():
                 st.markdown('<div class="chart-title">Field Locations</div>', unsafe_allow_html=True)
@@ -346,8 +319,7 @@ if uploaded_file is not None:
     st.subheader("Export Cleaned Data")
     
     # Prepare cleaned CSV with human-readable headers
-    export_df = clean_df.copy()
-    csv = export_df.to_csv(index=False).encode('utf-8')
+    csv = export_csv(file_hash, schema, clean_df)
     
     st.download_button(
         label="📥 Download Cleaned Dataset (CSV)",